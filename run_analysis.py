@@ -8,6 +8,7 @@ Verwendung:
     python run_analysis.py                    # Vollständige Analyse
     python run_analysis.py --osm-only        # Nur OSM-Extraktion
     python run_analysis.py --isochrones-only # Nur Isochronen
+    python run_analysis.py --force           # OSM-Extraktion erzwingen
 """
 
 import argparse
@@ -47,6 +48,12 @@ def main():
         help='Nur Isochronen berechnen'
     )
     
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='OSM-Flächen neu extrahieren, auch wenn die Ergebnisse aktueller als die PBF-Datei sind'
+    )
+    
     args = parser.parse_args()
     
     # API-Schlüssel aus Argumenten oder Umgebungsvariable
@@ -58,7 +65,7 @@ def main():
     try:
         if args.osm_only:
             print("📊 Extrahiere nur OSM-Flächen...")
-            extract_osm_areas(DATA_PATHS['osm_data'], DATA_PATHS['results_dir'])
+            extract_osm_areas(DATA_PATHS['osm_data'], DATA_PATHS['results_dir'], force=args.force)
             
         elif args.isochrones_only:
             print("📍 Berechne nur Isochronen...")
@@ -73,7 +80,7 @@ def main():
             if not api_key:
                 print("⚠️  Kein API-Schlüssel - Isochronen werden übersprungen")
                 print("   Für vollständige Analyse: OPENROUTESERVICE_API_KEY setzen")
-            run_full_analysis(api_key)
+            run_full_analysis(api_key, force=args.force)
         
         print("\n✅ Fertig!")
         
@@ -10,104 +10,305 @@ Author: Silas Pignotti
 Date: 2024
 """
 
+import hashlib
+import json
 import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import geopandas as gpd
+import numpy as np
 import openrouteservice as ors
 import osmium
-import shapely.wkb as wkblib
-from shapely.geometry import shape
+import shapely
+from requests.adapters import HTTPAdapter
+from shapely.geometry import mapping, shape
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 # Globale Konfiguration
 DATA_PATHS = {
     'daycare_centers_processed': Path('data/processed/daycare_centers_processed.geojson'),
     'osm_data': Path('data/raw/berlin-latest.osm.pbf'),
-    'results_dir': Path('data/results')
+    'results_dir': Path('data/results'),
+    'isochrone_cache': Path('data/cache/isochrones')
 }
 
 wkb_factory = osmium.geom.WKBFactory()
 
+# OSM-Tags für die Klassifikation von Wasser- und Grünflächen
+# (Schlüssel -> zulässige Werte)
+WATER_RULES = {
+    'natural': frozenset({'water'}),
+    'landuse': frozenset({'reservoir', 'basin'}),
+    'water': frozenset({'lake', 'river', 'pond'}),
+}
+WATER_KEYS = frozenset({'waterway'})  # Wasserfläche unabhängig vom Wert
+GREEN_RULES = {
+    'landuse': frozenset({
+        'grass', 'meadow', 'forest', 'greenfield',
+        'cemetery', 'recreation_ground'
+    }),
+    'leisure': frozenset({
+        'park', 'garden', 'playground', 'sports_centre',
+        'pitch', 'golf_course'
+    }),
+    'natural': frozenset({'wood'}),
+    'amenity': frozenset({'grave_yard'}),
+}
+OSM_AREA_KEYS = tuple(sorted(WATER_KEYS | WATER_RULES.keys() | GREEN_RULES.keys()))
+PROGRESS_STEP = 0x4000  # Elemente pro Fortschrittsaktualisierung (Zweierpotenz)
+
+UNION_CHUNK_SIZE = 128  # Geometrien pro Teilvereinigung in merge_geometries
+OVERLAP_CHUNKS_PER_WORKER = 4  # Arbeitspakete pro Thread in remove_overlapping_areas
+
+# OpenRouteService API-Limits
+ORS_MAX_REQUESTS = 450  # Anfragen pro Durchlauf
+ORS_REQUESTS_PER_MINUTE = 40
+ORS_LOCATIONS_PER_REQUEST = 5  # Maximale Standorte pro Isochronen-Anfrage
+ORS_MAX_WORKERS = 8  # Gleichzeitige Anfragen
+ORS_UNROUTABLE_ERROR_CODES = frozenset({3099})  # Standort nicht routbar
+
+# Parameter der Isochronen-Berechnung
+ISOCHRONE_PROFILE = 'foot-walking'
+ISOCHRONE_RANGE = 500  # Meter
+ISOCHRONE_CACHE_MAX_AGE_DAYS = 30  # Danach werden Isochronen neu abgefragt
+
+
+class RateLimiter:
+    """
+    Thread-sicherer Rate-Limiter mit gleitendem Zeitfenster.
+    
+    Lässt höchstens `max_calls` Aufrufe innerhalb von `period` Sekunden zu
+    und blockiert weitere Aufrufe, bis wieder ein Platz im Fenster frei ist.
+    Optional wird zusätzlich die Gesamtzahl der Aufrufe auf `max_total`
+    begrenzt.
+    """
+    
+    def __init__(self, max_calls: int, period: float = 60.0, max_total: Optional[int] = None):
+        self.max_calls = max_calls
+        self.period = period
+        self.max_total = max_total
+        self.total = 0
+        self._calls = deque()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+    
+    def acquire(self):
+        """
+        Wartet, bis eine weitere Anfrage erlaubt ist.
+        
+        Raises:
+            RuntimeError: Wenn das Gesamtkontingent aufgebraucht ist
+                oder der Rate-Limiter geschlossen wurde
+        """
+        while True:
+            with self._lock:
+                if self._closed.is_set():
+                    raise RuntimeError("Anfragen abgebrochen")
+                if self.max_total is not None and self.total >= self.max_total:
+                    raise RuntimeError(f"API-Limit ({self.max_total}) erreicht")
+                
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    self.total += 1
+                    return
+                
+                wait = self.period - (now - self._calls[0])
+            
+            self._closed.wait(wait)
+    
+    def close(self):
+        """Weckt wartende Aufrufe und lässt keine weiteren Anfragen zu."""
+        self._closed.set()
 
-class OSMAreaExtractor(osmium.SimpleHandler):
+
+class OSMAreaExtractor:
     """
     Extrahiert Grün- und Wasserflächen aus OpenStreetMap-Daten.
     
     Verarbeitet OSM-Elemente und klassifiziert sie basierend auf Tags
-    als Grünflächen oder Wasserflächen.
+    als Grünflächen oder Wasserflächen. Elemente ohne relevante Tags
+    werden bereits von libosmium verworfen.
     """
     
     def __init__(self):
-        super().__init__()
         self.green_areas = []
         self.water_areas = []
-        self.progress = tqdm(desc="Extrahiere OSM-Flächen", unit=" Elemente")
-    
-    def _extract_geometry(self, element):
-        """Extrahiert Geometrie aus OSM-Element."""
-        try:
-            if isinstance(element, osmium.osm.Area):
-                return wkblib.loads(wkb_factory.create_multipolygon(element))
-            else:
-                return wkblib.loads(wkb_factory.create_linestring(element))
-        except:
-            return None
-    
-    def _is_water_feature(self, tags):
-        """Prüft ob Element eine Wasserfläche ist."""
-        return (
-            tags.get('natural') == 'water' or
-            'waterway' in tags or
-            tags.get('landuse') in ['reservoir', 'basin'] or
-            tags.get('water') in ['lake', 'river', 'pond']
+        self.progress = tqdm(
+            desc="Extrahiere OSM-Flächen",
+            unit=" Elemente",
+            mininterval=0.5,
+            maxinterval=5
         )
+        self._count = 0
+        self.skipped = 0  # Elemente ohne gültige Geometrie
     
-    def _is_green_feature(self, tags):
-        """Prüft ob Element eine Grünfläche ist."""
-        return (
-            tags.get('landuse') in [
-                'grass', 'meadow', 'forest', 'greenfield', 
-                'cemetery', 'recreation_ground'
-            ] or 
-            tags.get('leisure') in [
-                'park', 'garden', 'playground', 'sports_centre', 
-                'pitch', 'golf_course'
-            ] or 
-            tags.get('natural') == 'wood' or 
-            tags.get('amenity') == 'grave_yard'
-        )
-    
-    def _process_element(self, element):
-        """Verarbeitet ein einzelnes OSM-Element."""
-        self.progress.update(1)
+    @staticmethod
+    def _classify(tags) -> Optional[str]:
+        """
+        Klassifiziert ein Element anhand seiner Tags.
         
-        geometry = self._extract_geometry(element)
-        if geometry is None:
+        Returns:
+            'water', 'green' oder None; Wasser hat Vorrang
+        """
+        for key in WATER_KEYS:
+            if key in tags:
+                return 'water'
+        for key, values in WATER_RULES.items():
+            if tags.get(key) in values:
+                return 'water'
+        for key, values in GREEN_RULES.items():
+            if tags.get(key) in values:
+                return 'green'
+        return None
+    
+    def _process_area(self, area):
+        """Verarbeitet eine Fläche (geschlossener Way oder Multipolygon)."""
+        # Erst klassifizieren, Geometrie nur für relevante Elemente erzeugen
+        category = self._classify(area.tags)
+        
+        if category == 'water':
+            target = self.water_areas
+        elif category == 'green':
+            target = self.green_areas
+        else:
             return
         
-        tags = dict(element.tags)
+        try:
+            target.append(wkb_factory.create_multipolygon(area))
+        except (osmium.InvalidLocationError, RuntimeError):
+            # Fehlende Knotenkoordinaten oder defekte Ringe
+            self.skipped += 1
+    
+    def _process_way(self, way):
+        """Verarbeitet eine Gewässerlinie (Way mit waterway-Tag)."""
+        if len(way.nodes) < 2:
+            self.skipped += 1
+            return
         
-        if self._is_water_feature(tags):
-            self.water_areas.append(geometry)
-        elif self._is_green_feature(tags):
-            self.green_areas.append(geometry)
-    
-    def area(self, area):
-        """Handler für Area-Elemente."""
-        self._process_element(area)
+        try:
+            self.water_areas.append(wkb_factory.create_linestring(way))
+        except (osmium.InvalidLocationError, RuntimeError):
+            # Fehlende Knotenkoordinaten oder nur ein eindeutiger Punkt
+            self.skipped += 1
     
-    def way(self, way):
-        """Handler für Way-Elemente.""" 
-        self._process_element(way)
+    def apply_file(self, osm_file: str):
+        """
+        Liest die OSM-Datei und verarbeitet alle Areas mit relevanten Tags
+        sowie alle Gewässerlinien.
+        
+        Flächige Ways liefert libosmium bereits als Area, ihre Umrisslinie
+        wird daher nicht zusätzlich übernommen.
+        
+        Args:
+            osm_file: Pfad zur OSM-PBF-Datei
+        """
+        tag_filter = osmium.filter.KeyFilter(*OSM_AREA_KEYS)
+        way_filter = osmium.filter.KeyFilter(*WATER_KEYS)
+        way_filter.enable_for(osmium.osm.WAY)
+        # Dekodierung der PBF-Blöcke auf alle Kerne bis auf einen verteilen,
+        # der verbleibende Kern verarbeitet die Elemente in Python
+        thread_pool = osmium.io.ThreadPool(num_threads=-1)
+        processor = (
+            osmium.FileProcessor(osm_file, thread_pool=thread_pool)
+            .with_areas(tag_filter)
+            .with_filter(osmium.filter.EntityFilter(osmium.osm.WAY | osmium.osm.AREA))
+            .with_filter(tag_filter)
+            .with_filter(way_filter)
+        )
+        
+        for element in processor:
+            # Fortschritt nur alle PROGRESS_STEP Elemente aktualisieren
+            self._count += 1
+            if self._count & (PROGRESS_STEP - 1) == 0:
+                self.progress.update(PROGRESS_STEP)
+            
+            if element.is_area():
+                self._process_area(element)
+            else:
+                self._process_way(element)
     
     def close(self):
-        """Schließt die Extraktion."""
+        """Schließt die Extraktion und dekodiert alle Geometrien gesammelt."""
+        self.green_areas = shapely.from_wkb(self.green_areas)
+        self.water_areas = shapely.from_wkb(self.water_areas)
+        self.progress.update(self._count & (PROGRESS_STEP - 1))
         self.progress.close()
         print(f"✅ Grünflächen gefunden: {len(self.green_areas)}")
         print(f"✅ Wasserflächen gefunden: {len(self.water_areas)}")
+        if self.skipped:
+            print(f"⚠️  {self.skipped} Elemente ohne gültige Geometrie übersprungen")
+
+
+class IsochroneCache:
+    """
+    Dateibasierter Cache für Isochronen der OpenRouteService API.
+    
+    Speichert jede Isochrone als eigene GeoJSON-Datei, deren Name aus
+    Koordinaten, Reichweite und Profil gebildet wird. Wiederholte
+    Durchläufe und abgebrochene Berechnungen fragen bekannte Standorte
+    so nicht erneut ab.
+    """
+    
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+    
+    def _path(self, x: float, y: float) -> Path:
+        """Bildet den Dateipfad für einen Standort."""
+        key = f"{x:.6f},{y:.6f},{ISOCHRONE_RANGE},{ISOCHRONE_PROFILE}"
+        return self.cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.geojson"
+    
+    def get(self, x: float, y: float):
+        """Liefert die gespeicherte Isochrone oder None."""
+        path = self._path(x, y)
+        if not path.exists():
+            return None
+        
+        try:
+            return shape(json.loads(path.read_text(encoding='utf-8')))
+        except (ValueError, KeyError):
+            return None
+    
+    def set(self, x: float, y: float, geometry):
+        """Speichert eine Isochrone."""
+        path = self._path(x, y)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        
+        # Erst vollständig schreiben, dann umbenennen
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(mapping(geometry)), encoding='utf-8')
+        tmp_path.replace(path)
+    
+    def invalidate_older_than(self, days: float) -> int:
+        """
+        Löscht Einträge, die älter als die angegebene Anzahl Tage sind.
+        
+        Args:
+            days: Maximales Alter eines Eintrags in Tagen
+            
+        Returns:
+            Anzahl gelöschter Einträge
+        """
+        if not self.cache_dir.exists():
+            return 0
+        
+        cutoff = time.time() - days * 24 * 60 * 60
+        removed = 0
+        for path in self.cache_dir.glob('*.geojson'):
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        
+        return removed
 
 
 class IsochroneGenerator:
@@ -118,15 +319,76 @@ class IsochroneGenerator:
     berücksichtigt API-Limits und Rate-Limiting.
     """
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache_dir: Path = DATA_PATHS['isochrone_cache']):
         """
         Initialisiert den Generator.
         
         Args:
             api_key: OpenRouteService API-Schlüssel
+            cache_dir: Verzeichnis für bereits abgefragte Isochronen
         """
         self.client = ors.Client(key=api_key) if api_key != '-' else None
+        self.cache = IsochroneCache(cache_dir)
+        
+        if self.client is not None:
+            # Eine Keep-alive-Verbindung pro Worker-Thread; HTTP-Fehler
+            # (429, 503) wiederholt der ORS-Client selbst
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=ORS_MAX_WORKERS,
+                max_retries=Retry(total=3, backoff_factor=1.5)
+            )
+            self.client._session.mount('https://', adapter)
+    
+    @staticmethod
+    def _is_unroutable(error: ors.exceptions.ApiError) -> bool:
+        """Prüft, ob ORS die Anfrage wegen eines nicht routbaren Standorts ablehnt."""
+        details = error.message.get('error') if isinstance(error.message, dict) else None
+        return isinstance(details, dict) and details.get('code') in ORS_UNROUTABLE_ERROR_CODES
+    
+    def _request_isochrones(self, rate_limiter: RateLimiter, locations: List[List[float]]) -> list:
+        """
+        Fragt die 500m-Fußweg-Isochronen für mehrere Standorte in einer Anfrage ab.
         
+        Args:
+            rate_limiter: Gemeinsamer Rate-Limiter aller Anfragen
+            locations: Liste von [Längengrad, Breitengrad]-Paaren
+            
+        Returns:
+            Liste der Geometrien in Reihenfolge der Standorte
+            (None, falls für einen Standort keine Isochrone geliefert wurde)
+        """
+        rate_limiter.acquire()
+        try:
+            result = self.client.isochrones(
+                locations=locations,
+                profile=ISOCHRONE_PROFILE,
+                range=[ISOCHRONE_RANGE],
+                attributes=['area']
+            )
+        except ors.exceptions.ApiError as e:
+            if len(locations) == 1 or not self._is_unroutable(e):
+                raise
+            # ORS verwirft die ganze Anfrage, wenn ein einzelner Standort nicht
+            # routbar ist; Standorte dann einzeln abfragen, damit nur dieser
+            # Standort verloren geht. Andere Fehler (Schlüssel, Kontingent)
+            # werden weitergereicht.
+            geometries = []
+            for location in locations:
+                try:
+                    geometries += self._request_isochrones(rate_limiter, [location])
+                except ors.exceptions.ApiError as e:
+                    if not self._is_unroutable(e):
+                        raise
+                    print(f"❌ Standort {location} nicht routbar: {e}")
+                    geometries.append(None)
+            return geometries
+        
+        geometries = [None] * len(locations)
+        for feature in result['features']:
+            geometries[feature['properties']['group_index']] = shape(feature['geometry'])
+        return geometries
+    
     def calculate_isochrones(self, daycare_file: Path, output_file: Path) -> gpd.GeoDataFrame:
         """
         Berechnet Isochronen für alle Kita-Standorte.
@@ -142,60 +404,142 @@ class IsochroneGenerator:
             print("⚠️  Kein API-Schlüssel - Isochrone-Berechnung übersprungen")
             return gpd.GeoDataFrame()
         
-        daycare_centers = gpd.read_file(daycare_file).to_crs('EPSG:4326')
-        geometries, node_ids = [], []
-        request_count = 0
-        max_requests = 450  # API-Limit
+        daycare_centers = gpd.read_file(daycare_file, engine='pyogrio')
+        if daycare_centers.crs != 'EPSG:4326':
+            daycare_centers = daycare_centers.to_crs('EPSG:4326')
+        
+        # Koordinaten und IDs einmalig als Arrays extrahieren; fehlende oder
+        # leere Geometrien liefern NaN statt einer Zeile weniger
+        points = daycare_centers.geometry.values
+        coords = np.column_stack([shapely.get_x(points), shapely.get_y(points)])
+        node_ids = daycare_centers.index.to_numpy()
+        
+        missing = np.isnan(coords).any(axis=1)
+        if missing.any():
+            print(f"⚠️  {missing.sum()} Kitas ohne Koordinaten übersprungen: {node_ids[missing].tolist()}")
+            coords = coords[~missing]
+            node_ids = node_ids[~missing]
+        
+        # Veraltete Einträge verwerfen, damit Änderungen im Wegenetz ankommen
+        expired = self.cache.invalidate_older_than(ISOCHRONE_CACHE_MAX_AGE_DAYS)
+        if expired:
+            print(f"🗑️  {expired} veraltete Isochronen aus Cache entfernt")
+        
+        # Bereits abgefragte Isochronen aus dem Cache übernehmen;
+        # Cache-Treffer verbrauchen kein API-Kontingent
+        results = {}
+        pending = []
+        for i, (x, y) in enumerate(coords.tolist()):
+            geometry = self.cache.get(x, y)
+            if geometry is None:
+                pending.append(i)
+            else:
+                results[node_ids[i]] = geometry
+        
+        if results:
+            print(f"♻️  {len(results)} Isochronen aus Cache übernommen")
         
-        print(f"🚀 Berechne Isochronen für {len(daycare_centers)} Kitas...")
+        max_daycare_centers = ORS_MAX_REQUESTS * ORS_LOCATIONS_PER_REQUEST
+        if len(pending) > max_daycare_centers:
+            print(f"⚠️  API-Limit ({ORS_MAX_REQUESTS}) erreicht")
+            pending = pending[:max_daycare_centers]
         
-        with tqdm(total=min(len(daycare_centers), max_requests), desc="Isochronen") as pbar:
-            batch_start = time.time()
+        print(f"🚀 Berechne Isochronen für {len(pending)} Kitas...")
+        
+        pending_coords = coords[pending]
+        pending_ids = node_ids[pending]
+        
+        # Parallele Anfragen, begrenzt durch das Rate-Limit der API; auch
+        # Einzelabfragen nach abgelehnten Gruppen zählen zum Kontingent
+        rate_limiter = RateLimiter(ORS_REQUESTS_PER_MINUTE, period=60, max_total=ORS_MAX_REQUESTS)
+        
+        with ThreadPoolExecutor(max_workers=ORS_MAX_WORKERS) as executor, \
+                tqdm(total=len(pending), desc="Isochronen") as pbar:
+            # Standorte in Gruppen zu je einer Anfrage bündeln
+            futures = {}
+            for start in range(0, len(pending), ORS_LOCATIONS_PER_REQUEST):
+                locations = pending_coords[start:start + ORS_LOCATIONS_PER_REQUEST].tolist()
+                batch_ids = pending_ids[start:start + ORS_LOCATIONS_PER_REQUEST].tolist()
+                future = executor.submit(self._request_isochrones, rate_limiter, locations)
+                futures[future] = (batch_ids, locations)
             
-            for idx, (_, daycare) in enumerate(daycare_centers.iterrows()):
-                if request_count >= max_requests:
-                    print(f"⚠️  API-Limit ({max_requests}) erreicht")
-                    break
-                
-                try:
-                    # API-Anfrage
-                    result = self.client.isochrones(
-                        locations=[[daycare.geometry.x, daycare.geometry.y]],
-                        profile='foot-walking',
-                        range=[500],
-                        attributes=['area']
-                    )
-                    
-                    geometry = shape(result['features'][0]['geometry'])
-                    geometries.append(geometry)
-                    node_ids.append(daycare.name)
-                    request_count += 1
-                    pbar.update(1)
-                    
-                    # Rate Limiting: 11 Requests/Minute
-                    if idx % 11 == 10:
-                        elapsed = time.time() - batch_start
-                        if elapsed < 60:
-                            time.sleep(60 - elapsed)
-                        batch_start = time.time()
-                
-                except Exception as e:
-                    print(f"❌ Fehler bei Kita {daycare.name}: {e}")
-                    continue
+            try:
+                for future in as_completed(futures):
+                    batch_ids, locations = futures[future]
+                    pbar.update(len(batch_ids))
+                    try:
+                        for node_id, (x, y), geometry in zip(batch_ids, locations, future.result()):
+                            if geometry is not None:
+                                results[node_id] = geometry
+                                # Sofort sichern, damit ein Abbruch nichts verliert
+                                self.cache.set(x, y, geometry)
+                    except Exception as e:
+                        print(f"❌ Fehler bei Kitas {batch_ids}: {e}")
+            except BaseException:
+                # Bei Abbruch (z.B. Strg+C) wartende Gruppen verwerfen, statt
+                # beim Verlassen des Executors noch das Kontingent zu verbrauchen;
+                # shutdown(cancel_futures=True) gibt es erst ab Python 3.9
+                for future in futures:
+                    future.cancel()
+                rate_limiter.close()
+                raise
+        
+        # Reihenfolge der Eingabedaten beibehalten
+        node_ids = [node_id for node_id in node_ids.tolist() if node_id in results]
+        geometries = np.array([results[node_id] for node_id in node_ids], dtype=object)
+        
+        # Ungültige Geometrien (z.B. selbstschneidende Ringe) einmalig
+        # reparieren, bevor sie in die Überlappungsbereinigung gehen
+        invalid = ~shapely.is_valid(geometries)
+        if invalid.any():
+            geometries[invalid] = shapely.make_valid(geometries[invalid])
+            print(f"🔧 {invalid.sum()} ungültige Isochronen repariert")
         
         # Ergebnisse speichern
-        if geometries:
+        if len(geometries) > 0:
             isochrones = gpd.GeoDataFrame(
                 {'node_id': node_ids, 'geometry': geometries}, 
                 crs='EPSG:4326'
             )
-            isochrones.to_file(output_file, driver='GeoJSON')
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            # Ohne räumlichen Index, der die Features umsortieren würde
+            isochrones.to_file(output_file, driver='FlatGeobuf', engine='pyogrio', spatial_index=False)
             print(f"✅ {len(geometries)} Isochronen gespeichert: {output_file}")
             return isochrones
         
         return gpd.GeoDataFrame()
 
 
+def _subtract_later_neighbours(geometries: np.ndarray, left: np.ndarray,
+                               right: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Zieht Isochronen ihre späteren Nachbarn der Reihe nach ab.
+    
+    Args:
+        geometries: Unveränderte Geometrien aller Isochronen
+        left: Indizes der zu bereinigenden Isochronen, sortiert
+        right: Indizes der jeweiligen Nachbarn, je Isochrone aufsteigend
+        
+    Returns:
+        Tuple aus (Indizes der Isochronen, bereinigte Geometrien)
+    """
+    targets, first_pair = np.unique(left, return_index=True)
+    position = np.searchsorted(targets, left)
+    rank = np.arange(len(left)) - first_pair[position]
+    
+    # In Runde k wird jeder Isochrone ihr k-ter späterer Nachbar abgezogen,
+    # für alle Isochronen gemeinsam in einem vektorisierten GEOS-Aufruf
+    cleaned = geometries[targets]
+    n_rounds = rank.max() + 1 if len(rank) > 0 else 0
+    for k in range(n_rounds):
+        selected = position[rank == k]
+        cleaned[selected] = shapely.difference(
+            cleaned[selected], geometries[right[rank == k]]
+        )
+    
+    return targets, cleaned
+
+
 def remove_overlapping_areas(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     """
     Entfernt Überlappungen zwischen Isochronen.
@@ -210,38 +554,100 @@ def remove_overlapping_areas(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         return gdf
     
     print("🔧 Entferne Überlappungen...")
-    geometries = list(gdf.geometry)
-    
-    for i in tqdm(range(len(geometries)), desc="Überlappungen"):
-        for j in range(i + 1, len(geometries)):
-            if geometries[i].intersects(geometries[j]):
-                geometries[i] = geometries[i].difference(geometries[j])
+    geometries = gdf.geometry.to_numpy()
+    shapely.prepare(geometries)
+    
+    # Kandidatenpaare (i, j) mit j > i über die Bounding-Boxen bestimmen;
+    # das exakte Prädikat läuft danach nur noch einmal pro Paar. Abgezogen
+    # werden immer die unveränderten Nachbarn, der Baum bleibt daher gültig.
+    tree = shapely.STRtree(geometries)
+    left, right = tree.query(geometries)
+    later = right > left
+    left, right = left[later], right[later]
+    
+    intersecting = shapely.intersects(geometries[left], geometries[right])
+    left, right = left[intersecting], right[intersecting]
+    order = np.lexsort((right, left))
+    left, right = left[order], right[order]
+    
+    # Paare in etwa gleich große Blöcke teilen, ohne die Paare einer
+    # Isochrone zu trennen; GEOS gibt den GIL frei, die Blöcke laufen parallel
+    n_workers = os.cpu_count() or 1
+    n_chunks = min(len(left), n_workers * OVERLAP_CHUNKS_PER_WORKER)
+    cut_positions = np.linspace(0, len(left), n_chunks + 1)[1:-1].astype(int)
+    cuts = np.unique(np.searchsorted(left, left[cut_positions]))
+    chunks = [
+        (left[start:end], right[start:end])
+        for start, end in zip(np.r_[0, cuts], np.r_[cuts, len(left)])
+        if end > start
+    ]
+    
+    cleaned = geometries.copy()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = executor.map(
+            lambda chunk: _subtract_later_neighbours(geometries, *chunk),
+            chunks
+        )
+        for targets, parts in tqdm(results, total=len(chunks), desc="Überlappungen"):
+            cleaned[targets] = parts
     
     result = gdf.copy()
-    result.geometry = geometries
+    result.geometry = cleaned
     return result
 
 
 def merge_geometries(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """Vereinigt alle Geometrien zu einer einzigen."""
+    """
+    Vereinigt alle Geometrien zu einer einzigen.
+    
+    Die Geometrien werden entlang einer Hilbert-Kurve sortiert und in
+    räumlich benachbarten Gruppen vorvereinigt, bevor die Teilergebnisse
+    zusammengeführt werden. Das hält die Zwischenergebnisse klein.
+    Die Gruppen werden parallel vereinigt, GEOS gibt dabei den GIL frei.
+    """
     if len(gdf) == 0:
         return gdf
     
-    unified_geometry = gdf.union_all()
+    order = np.argsort(gdf.geometry.hilbert_distance().to_numpy())
+    geometries = gdf.geometry.to_numpy()[order]
+    
+    chunks = [
+        geometries[start:start + UNION_CHUNK_SIZE]
+        for start in range(0, len(geometries), UNION_CHUNK_SIZE)
+    ]
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        partial_unions = list(executor.map(shapely.union_all, chunks))
+    unified_geometry = shapely.union_all(partial_unions)
+    
     return gpd.GeoDataFrame(geometry=[unified_geometry], crs=gdf.crs)
 
 
-def extract_osm_areas(osm_file: Path, output_dir: Path) -> Tuple[Path, Path]:
+def extract_osm_areas(osm_file: Path, output_dir: Path, force: bool = False) -> Tuple[Path, Path]:
     """
     Extrahiert Grün- und Wasserflächen aus OSM-Daten.
     
+    Sind beide Ergebnisdateien neuer als die OSM-Datei, wird die
+    Extraktion übersprungen.
+    
     Args:
         osm_file: Pfad zur OSM-PBF-Datei
         output_dir: Ausgabeverzeichnis
+        force: Extraktion auch bei aktuellen Ergebnissen erneut ausführen
         
     Returns:
         Tuple aus (Grünflächen-Pfad, Wasserflächen-Pfad)
     """
+    green_path = output_dir / 'berlin_green_areas.fgb'
+    water_path = output_dir / 'berlin_water_areas.fgb'
+    
+    osm_mtime = osm_file.stat().st_mtime
+    if not force and all(
+        path.exists() and path.stat().st_mtime > osm_mtime
+        for path in (green_path, water_path)
+    ):
+        print(f"♻️  Flächen aktueller als {osm_file.name} - Extraktion übersprungen")
+        return green_path, water_path
+    
     print(f"📊 Extrahiere Flächen aus {osm_file}...")
     
     extractor = OSMAreaExtractor()
@@ -252,21 +658,17 @@ def extract_osm_areas(osm_file: Path, output_dir: Path) -> Tuple[Path, Path]:
     green_gdf = gpd.GeoDataFrame(geometry=extractor.green_areas, crs="EPSG:4326")
     water_gdf = gpd.GeoDataFrame(geometry=extractor.water_areas, crs="EPSG:4326")
     
-    # Vereinige und speichere
+    # Vereinige und speichere; leere Kategorien werden als leere Layer
+    # geschrieben, damit die Aktualitätsprüfung beim nächsten Lauf greift
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    green_path = output_dir / 'berlin_green_areas.geojson'
-    water_path = output_dir / 'berlin_water_areas.geojson'
-    
-    if len(green_gdf) > 0:
-        green_unified = merge_geometries(green_gdf)
-        green_unified.to_file(green_path, driver="GeoJSON")
-        print(f"✅ Grünflächen gespeichert: {green_path}")
+    green_unified = merge_geometries(green_gdf)
+    green_unified.to_file(green_path, driver="FlatGeobuf", engine='pyogrio', spatial_index=True)
+    print(f"✅ Grünflächen gespeichert: {green_path}")
     
-    if len(water_gdf) > 0:
-        water_unified = merge_geometries(water_gdf)
-        water_unified.to_file(water_path, driver="GeoJSON")
-        print(f"✅ Wasserflächen gespeichert: {water_path}")
+    water_unified = merge_geometries(water_gdf)
+    water_unified.to_file(water_path, driver="FlatGeobuf", engine='pyogrio', spatial_index=True)
+    print(f"✅ Wasserflächen gespeichert: {water_path}")
     
     return green_path, water_path
 
@@ -285,7 +687,7 @@ def generate_isochrones(api_key: str = None) -> Path:
         api_key = os.getenv('OPENROUTESERVICE_API_KEY', '-')
     
     generator = IsochroneGenerator(api_key)
-    output_file = DATA_PATHS['results_dir'] / 'isochrones.geojson'
+    output_file = DATA_PATHS['results_dir'] / 'isochrones.fgb'
     
     # Berechne Isochronen
     isochrones = generator.calculate_isochrones(
@@ -296,8 +698,8 @@ def generate_isochrones(api_key: str = None) -> Path:
     # Entferne Überlappungen falls Daten vorhanden
     if len(isochrones) > 0:
         clean_isochrones = remove_overlapping_areas(isochrones)
-        clean_output = DATA_PATHS['results_dir'] / 'isochrones_overlapping.geojson'
-        clean_isochrones.to_file(clean_output, driver='GeoJSON')
+        clean_output = DATA_PATHS['results_dir'] / 'isochrones_overlapping.fgb'
+        clean_isochrones.to_file(clean_output, driver='FlatGeobuf', engine='pyogrio', spatial_index=False)
         print(f"✅ Bereinigte Isochronen: {clean_output}")
         
         return clean_output
@@ -305,12 +707,13 @@ def generate_isochrones(api_key: str = None) -> Path:
     return output_file
 
 
-def run_full_analysis(api_key: str = None):
+def run_full_analysis(api_key: str = None, force: bool = False):
     """
     Führt die komplette räumliche Analyse durch.
     
     Args:
         api_key: OpenRouteService API-Schlüssel (optional)
+        force: OSM-Extraktion auch bei aktuellen Ergebnissen erneut ausführen
     """
     print("🎯 Starte räumliche Analyse für Berliner Kitas\n")
     
@@ -318,7 +721,8 @@ def run_full_analysis(api_key: str = None):
     print("1️⃣ Extrahiere Grün- und Wasserflächen...")
     green_path, water_path = extract_osm_areas(
         DATA_PATHS['osm_data'],
-        DATA_PATHS['results_dir']
+        DATA_PATHS['results_dir'],
+        force=force
     )
     
     print("\n2️⃣ Generiere Isochronen...")